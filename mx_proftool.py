@@ -24,9 +24,11 @@
 #
 # ----------------------------------------------------------------------------------------------------
 
-import copy
+import functools
+import heapq
 import io
 import json
+import mmap
 import os
 import re
 import shutil
@@ -36,7 +38,12 @@ import sys
 import zipfile
 from abc import ABCMeta, abstractmethod
 from argparse import ArgumentParser, Action, OPTIONAL, RawTextHelpFormatter, REMAINDER
-from itertools import islice
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, islice, repeat
+from operator import attrgetter, itemgetter
 from typing import Optional, NamedTuple, Iterable, List
 from xml.etree import ElementTree
 from zipfile import ZipFile
@@ -76,12 +83,19 @@ filetag = b"JVMTIASM"
 MajorVersion = 1
 MinorVersion = 0
 
-# Marker values for various data sections
-DynamicCodeTag, = struct.unpack('>i', b'DYNC')
-CompiledMethodLoadTag, = struct.unpack('>i', b'CMLT')
-MethodsTag, = struct.unpack('>i', b'MTHT')
-DebugInfoTag, = struct.unpack('>i', b'DEBI')
-CompiledMethodUnloadTag, = struct.unpack('>i', b'CMUT')
+# Marker values for various data sections, which are the big endian jint encodings of the ASCII tags
+DynamicCodeTag = 0x44594E43           # b'DYNC'
+CompiledMethodLoadTag = 0x434D4C54    # b'CMLT'
+MethodsTag = 0x4D544854               # b'MTHT'
+DebugInfoTag = 0x44454249             # b'DEBI'
+CompiledMethodUnloadTag = 0x434D5554  # b'CMUT'
+
+# Big endian encodings of the primitive fields
+JIntStruct = struct.Struct('>i')
+JLongStruct = struct.Struct('>Q')
+TimestampStruct = struct.Struct('>QQ')
+LineNumberEntryStruct = struct.Struct('>Qi')
+DebugInfoHeaderStruct = struct.Struct('>Qi')
 
 
 class ExperimentFiles(object, metaclass=ABCMeta):
@@ -224,7 +238,8 @@ class FlatExperimentFiles(ExperimentFiles):
         return self.jvmti_asm_filename and os.path.exists(self.jvmti_asm_filename)
 
     def open_perf_output_file(self, mode='r'):
-        return open(self.perf_output_filename, mode)
+        # the perf output is large and is written and read line by line so use large buffers
+        return open(self.perf_output_filename, mode, buffering=1 << 20)
 
     def get_jvmti_asm_filename(self):
         return self.jvmti_asm_filename
@@ -323,6 +338,13 @@ class ZipExperimentFiles(ExperimentFiles):
     def __init__(self, filename):
         super(ZipExperimentFiles, self).__init__()
         self.experiment_file = ZipFile(filename)
+        # map the last component of each archive member, keeping the trailing separator of directories,
+        # to the first member with that name
+        self.files_by_name = {}
+        for f in self.experiment_file.namelist():
+            directory, sep, _ = f.rstrip(os.sep).rpartition(os.sep)
+            if sep:
+                self.files_by_name.setdefault(f[len(directory) + 1:], f)
         self.jvmti_asm_file = self.find_file('jvmti_asm_file', error=False)
         self.perf_output_filename = self.find_file('perf_output_file')
         self.log_compilation_filename = self.find_file('log_compilation', error=False)
@@ -330,18 +352,15 @@ class ZipExperimentFiles(ExperimentFiles):
         self.native_image_tag_file = self.find_file(NATIVE_IMAGE_TAG, error=False)
 
     def find_file(self, name, error=True):
-        for f in self.experiment_file.namelist():
-            if f.endswith(os.sep + name):
-                return f
-        if error:
+        f = self.files_by_name.get(name)
+        if f is None and error:
             mx.abort('Missing file ' + name)
+        return f
 
     def open_jvmti_asm_file(self):
-        with self.experiment_file.open(self.jvmti_asm_file, 'r') as fp:
-            # These files can be large and zip i/o is somewhat slow, so
-            # reading the whole file at once significantly improves
-            # the processing speed.
-            return io.BytesIO(fp.read())
+        # The member can't be memory mapped so GeneratedAssembly.map_file reads it whole, which is
+        # much faster than the many small reads of parsing it from the zip stream.
+        return self.experiment_file.open(self.jvmti_asm_file, 'r')
 
     def has_assembly(self):
         return self.jvmti_asm_file is not None
@@ -351,7 +370,11 @@ class ZipExperimentFiles(ExperimentFiles):
             mx.abort('perf output missing in archive')
 
     def open_perf_output_file(self, mode='r'):
-        return io.TextIOWrapper(self.experiment_file.open(self.perf_output_filename, mode), encoding='utf-8')
+        fp = self.experiment_file.open(self.perf_output_filename, mode)
+        if mode == 'r':
+            # inflate the perf output in large blocks since it's consumed line by line
+            fp = io.BufferedReader(fp, buffer_size=1 << 20)
+        return io.TextIOWrapper(fp, encoding='utf-8', newline='')
 
     def open_log_compilation_file(self):
         return io.TextIOWrapper(self.experiment_file.open(self.log_compilation_filename, 'r'), encoding='utf-8')
@@ -393,6 +416,8 @@ class ZipExperimentFiles(ExperimentFiles):
 class Instruction:
     """A simple wrapper around a CapStone instruction to support data instructions."""
 
+    __slots__ = ('address', 'mnemonic', 'operand', 'bytes', 'size', 'insn', 'prefix', 'comments')
+
     def __init__(self, address, mnemonic, operand, instruction_bytes, size, insn=None):
         self.address = address
         self.mnemonic = mnemonic
@@ -432,29 +457,60 @@ class DisassemblyDecoder:
     def add_annotator(self, annotator):
         self.annotators.append(annotator)
 
+    def set_annotators(self, annotators):
+        """Replace the current annotators so that a decoder can be reused for another piece of code."""
+        self.annotators = list(annotators)
+
     def successors(self, instruction):
         raise NotImplementedError()
 
-    def disassemble_with_skip(self, code, code_addr):
-        instructions = [Instruction(i.address, i.mnemonic, i.op_str, i.bytes, i.size, i) for i in
-                        self.decoder.disasm(code, code_addr)]
+    def disassemble_with_skip(self, code, code_addr, decoded=None):
+        """
+        Decode code into Instructions.  decoded is the result of decode_lite_with_skip for this code if it
+        has already been computed elsewhere.
+        """
+        if decoded is None:
+            decoded = self.decode_lite_with_skip(code, code_addr)
+        return self.build_instructions(code, code_addr, decoded)
+
+    def needs_detail(self, mnemonic):
+        """
+        Returns whether an instruction with this mnemonic needs the full Capstone instruction, which is only
+        required to analyze control flow.
+        """
+        return True
+
+    def decode_lite_with_skip(self, code, code_addr):
+        """
+        Decode code into (address, size, mnemonic, operand) tuples using the cheap disasm_lite, emitting a .byte
+        pseudo instruction for each byte that can't be decoded.  The result is plain data so it can be computed
+        in another process.
+        """
+        decoded = []
+        append = decoded.append
+        disasm_lite = self.decoder.disasm_lite
         total_size = len(code)
-        if instructions:
-            last = instructions[-1]
-            decoded_bytes = last.address + last.size - code_addr
-        else:
-            decoded_bytes = 0
+        decoded_bytes = 0
         while decoded_bytes != total_size:
-            new_instructions = [Instruction(i.address, i.mnemonic, i.op_str, i.bytes, i.size, i) for i in
-                                self.decoder.disasm(code[decoded_bytes:], code_addr + decoded_bytes)]
-            if new_instructions:
-                instructions.extend(new_instructions)
-                last = instructions[-1]
-                decoded_bytes = last.address + last.size - code_addr
-            else:
-                instructions.append(Instruction(code_addr + decoded_bytes, '.byte', f'{code[decoded_bytes]:0x}',
-                                                code[decoded_bytes:decoded_bytes + 1], 1))
+            resume = decoded_bytes
+            for instruction in disasm_lite(code[decoded_bytes:], code_addr + decoded_bytes):
+                append(instruction)
+                decoded_bytes += instruction[1]
+            if decoded_bytes == resume:
+                append((code_addr + decoded_bytes, 1, '.byte', f'{code[decoded_bytes]:0x}'))
                 decoded_bytes += 1
+        return decoded
+
+    def build_instructions(self, code, code_addr, decoded):
+        """Wrap the result of decode_lite_with_skip, decoding the full Capstone instruction only where needed."""
+        disasm = self.decoder.disasm
+        needs_detail = self.needs_detail
+        instructions = [None] * len(decoded)
+        for index, (address, size, mnemonic, op_str) in enumerate(decoded):
+            offset = address - code_addr
+            instruction_bytes = code[offset:offset + size]
+            insn = next(disasm(instruction_bytes, address, 1)) if needs_detail(mnemonic) else None
+            instructions[index] = Instruction(address, mnemonic, op_str, instruction_bytes, size, insn)
         return instructions
 
     def find_jump_targets(self, instructions):
@@ -493,17 +549,21 @@ class DisassemblyDecoder:
         return preannotations[0] if preannotations else None, postannotations
 
     def filter_by_hot_region(self, instructions, hotpc, threshold, context_size=16):
-        index = 0
+        if not hotpc:
+            return []
         begin = None
         skip = 0
         regions = []
-        for index in range(len(instructions)):
-            instruction = instructions[index]
-            if instruction.address in hotpc:
-                event = hotpc.pop(instruction.address)
-                if threshold:
-                    if event.percent < threshold:
-                        continue
+        attributed = set()
+        attribute = attributed.add
+        hot_event = hotpc.get
+        index = 0
+        for index, instruction in enumerate(instructions):
+            event = hot_event(instruction.address)
+            if event is not None:
+                attribute(instruction.address)
+                if threshold and event.percent < threshold:
+                    continue
                 skip = 0
                 if not begin:
                     begin = max(index - context_size, 0)
@@ -515,48 +575,46 @@ class DisassemblyDecoder:
                 skip = 0
         if begin:
             regions.append((begin, index))
-        if len(hotpc) != 0:
-            print(f"Unattributed pcs {[f'{x:x}' for x in list(hotpc)]}")
+        if len(attributed) != len(hotpc):
+            print(f"Unattributed pcs {[f'{x:x}' for x in hotpc if x not in attributed]}")
         return regions
 
-    def disassemble(self, code, hotpc, short_class_names=False, threshold=0.001):
-        instructions = self.disassemble_with_skip(code.code, code.code_addr)
+    def disassemble(self, code, hotpc, short_class_names=False, threshold=0.001, decoded=None):
+        instructions = self.disassemble_with_skip(code.code, code.code_addr, decoded)
         if threshold == 0:
             regions = [(0, len(instructions))]
         else:
             regions = self.filter_by_hot_region(instructions, hotpc, threshold)
         instructions = [(i,) + self.get_annotations(i) for i in instructions]
         prefix_width = max(len(p) if p else 0 for i, p, a in instructions) + 1
-        prefix_format = '{:' + str(prefix_width) + '}'
         region = 1
 
         for begin, end in regions:
+            # collect the whole region and emit it with a single write
+            out = []
             if threshold != 0:
                 if region != 1:
-                    self.print(code.format_name(short_class_names=short_class_names))
-                self.print(f"Hot region {region}")
+                    out.append(f'{code.format_name(short_class_names=short_class_names)}\n')
+                out.append(f'Hot region {region}\n')
             for i, prefix, annotations in instructions[begin:end]:
-                hex_bytes = ''
-                if self.hex_bytes:
-                    hex_bytes = ' '.join([f'{b:02x}' for b in i.bytes])
+                hex_bytes = i.bytes.hex(' ') if self.hex_bytes else ''
                 if prefix is None:
                     prefix = ' ' * prefix_width
                 else:
-                    prefix = prefix_format.format(prefix)
+                    prefix = f'{prefix:{prefix_width}}'
                 assert len(prefix) == prefix_width, f'{prefix} {prefix_width}'
-                line = f'{prefix}0x{i.address:x}:\t{i.mnemonic}\t{i.operand}\t{hex_bytes}'
-                line = line.expandtabs()
+                line = f'{prefix}0x{i.address:x}:\t{i.mnemonic}\t{i.operand}\t{hex_bytes}'.expandtabs()
                 if annotations:
+                    out.append(f'{line}; {annotations[0]}\n')
                     padding = ' ' * len(line)
-                    lines = [padding] * len(annotations)
-                    lines[0] = line
-                    for a, b in zip(lines, annotations):
-                        self.print(f'{a}; {b}')
+                    for annotation in annotations[1:]:
+                        out.append(f'{padding}; {annotation}\n')
                 else:
-                    self.print(line)
+                    out.append(f'{line}\n')
             if threshold != 0:
-                self.print(f"End of hot region {region}")
-            self.print('')
+                out.append(f'End of hot region {region}\n')
+            out.append('\n')
+            self.fp.write(''.join(out))
             region += 1
 
         last, _, _ = instructions[-1]
@@ -570,6 +628,10 @@ class AMD64DisassemblerDecoder(DisassemblyDecoder):
     def __init__(self, fp):
         DisassemblyDecoder.__init__(self, capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64), fp)
 
+    def needs_detail(self, mnemonic):
+        # calls, jumps, loops and returns, including prefixed forms like 'notrack jmp' or 'bnd call'
+        return mnemonic.startswith(('j', 'loop', 'ret')) or 'call' in mnemonic or 'jmp' in mnemonic
+
     def successors(self, i):
         if len(i.groups) > 0:
             groups = [i.group_name(g) for g in i.groups]
@@ -591,6 +653,11 @@ class AArch64DisassemblyDecoder(DisassemblyDecoder):
     def __init__(self, fp):
         DisassemblyDecoder.__init__(self, capstone.Cs(capstone.CS_ARCH_ARM64, capstone.CS_MODE_ARM), fp)
 
+    def needs_detail(self, mnemonic):
+        # b, b.cond, bl, blr, br, cbz, cbnz, tbz, tbnz and ret.  Some data processing instructions
+        # also start with b but decoding them in full is harmless.
+        return mnemonic.startswith(('b', 'cb', 'tb', 'ret'))
+
     def successors(self, i):
         if len(i.groups) > 0:
             groups = [i.group_name(g) for g in i.groups]
@@ -603,7 +670,30 @@ class AArch64DisassemblyDecoder(DisassemblyDecoder):
             return True
 
 
-method_signature_re = re.compile(r'((?:\[*[VIJFDSCBZ])|(?:\[*L[^;]+;))')
+# decoders created by decode_in_worker, one per decoder class in each worker process
+worker_decoders = {}
+# the least machine code for which starting the decode workers and pickling the code and results costs less
+# than it saves
+ParallelDecodeMinBytes = 256 * 1024
+
+
+def decode_in_worker(decoder_class, code, code_addr):
+    """
+    Run the decode_lite_with_skip pass of a decoder in a worker process.  Capstone instructions can't be
+    pickled so the full instructions are built by the parent from the returned tuples.
+    """
+    decoder = worker_decoders.get(decoder_class)
+    if decoder is None:
+        decoder = decoder_class(None)
+        worker_decoders[decoder_class] = decoder
+    return decoder.decode_lite_with_skip(code, code_addr)
+
+
+method_signature_re = re.compile(r'((?:\[*[VIJFDSCBZ])|(?:\[*L[^;]+;))', re.ASCII)
+perf_re = re.compile(r'(?P<timestamp>[0-9]+\.[0-9]*):\s+(?P<period>[0-9]*)\s+(?P<events>[^\s]*):\s+'
+                     r'(?P<pc>[a-fA-F0-9]+)\s+(?P<symbol>.*)\s+\((?P<dso>.*)\)\s*')
+# the timestamp, period, events and pc fields of perf_re
+perf_prefix_re = re.compile(r'\s*([0-9]+\.[0-9]*):\s+([0-9]+)\s+([^\s]*):\s+([a-fA-F0-9]+)\s+')
 primitive_types = {'I': 'int', 'J': 'long', 'V': 'void', 'F': 'float', 'D': 'double',
                    'S': 'short', 'C': 'char', 'B': 'byte', 'Z': 'boolean'}
 
@@ -623,13 +713,11 @@ class Method:
 
     def __init__(self, class_signature, name, method_signature, source_file, line_number_table):
         self.line_number_table = line_number_table
-        self.name = name
-        args, return_type = method_signature[1:].split(')')
-        arguments = re.findall(method_signature_re, args)
-        self.method_arguments = [Method.decode_type(x) for x in arguments]
-        self.return_type = Method.decode_type(return_type)
+        self.name = sys.intern(name)
+        self.method_arguments, self.return_type = Method.decode_method_signature(method_signature)
         self.source_file = source_file
         self.class_signature = Method.decode_class_signature(class_signature)
+        self.formatted_names = {}
 
     @staticmethod
     def format_type(typestr, short_class_names):
@@ -646,8 +734,14 @@ class Method:
             return types
 
     def format_name(self, with_arguments=True, short_class_names=False):
-        return Method.format_type(self.class_signature, short_class_names) + '.' + self.name +\
-               (('(' + ', '.join(Method.format_types(self.method_arguments, short_class_names)) + ')') if with_arguments else '')
+        # names are formatted for every frame of every annotated instruction so remember each variant
+        key = (with_arguments, short_class_names)
+        name = self.formatted_names.get(key)
+        if name is None:
+            name = Method.format_type(self.class_signature, short_class_names) + '.' + self.name +\
+                   (('(' + ', '.join(Method.format_types(self.method_arguments, short_class_names)) + ')') if with_arguments else '')
+            self.formatted_names[key] = name
+        return name
 
     def method_filter_format(self, with_arguments=False):
         return self.format_name(with_arguments=with_arguments)
@@ -655,7 +749,19 @@ class Method:
     def __repr__(self):
         return self.format_name()
 
+    # The same signatures and types recur across many methods so the decoding is cached and the
+    # resulting strings are interned to share them between all the Methods.
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8192)
+    def decode_method_signature(method_signature):
+        """Returns a tuple of the decoded argument types and the decoded return type."""
+        args, return_type = method_signature[1:].split(')')
+        arguments = tuple(Method.decode_type(x) for x in re.findall(method_signature_re, args))
+        return arguments, Method.decode_type(return_type)
+
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def decode_type(argument_type):
         result = argument_type
         arrays = ''
@@ -666,12 +772,13 @@ class Method:
             result = primitive_types[result]
         else:
             result = Method.decode_class_signature(result)
-        return result + arrays
+        return sys.intern(result + arrays)
 
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def decode_class_signature(signature):
         if signature[0] == 'L' and signature[-1] == ';':
-            return signature[1:-1].replace('/', '.')
+            return sys.intern(signature[1:-1].replace('/', '.'))
         raise AssertionError('Bad signature: ' + signature)
 
 
@@ -693,12 +800,17 @@ class DebugInfo:
 class CompiledCodeInfo:
     """A generated chunk of HotSpot assembly, including any metadata"""
 
+    __slots__ = ('timestamp', 'code', 'code_size', 'code_addr', 'code_end_addr', 'name', 'debug_info',
+                 'debug_info_map', 'unload_time', 'generated', 'events', 'event_map', 'total_period',
+                 'total_samples', 'methods', 'nmethod', 'basic_blocks')
+
     def __init__(self, name, timestamp, code_addr, code_size,
                  code, generated, debug_info=None, methods=None):
         self.timestamp = timestamp
         self.code = code
         self.code_size = code_size
         self.code_addr = code_addr
+        self.code_end_addr = code_addr + code_size
         self.name = name
         self.debug_info = debug_info
         self.debug_info_map = None
@@ -751,24 +863,26 @@ class CompiledCodeInfo:
         return self.code_addr
 
     def code_end(self):
-        return self.code_addr + self.code_size
+        return self.code_end_addr
 
     def contains(self, pc, timestamp=None):
-        if self.code_addr <= pc < self.code_end():
+        if self.code_addr <= pc < self.code_end_addr:
             # early stubs have a timestamp that is after their actual creation time
             # so treat any code which was never unloaded as persistent.
             return self.generated or timestamp is None or self.contains_timestamp(timestamp)
         return False
 
     def add(self, event):
-        assert self.code_addr <= event.pc < self.code_end()
+        assert self.code_addr <= event.pc < self.code_end_addr
         self.events.append(event)
+        self.event_map = None
         self.total_period += event.period
         self.total_samples += event.samples
         if self.basic_blocks:
             # if we have basic block information, we search for the basic block the sample belongs to
+            offset = event.pc - self.code_addr
             for b in self.basic_blocks:
-                if self.code_begin() + b.start <= event.pc < self.code_begin() + b.end:
+                if b.start <= offset < b.end:
                     b.period += event.period
                     b.samples += event.samples
 
@@ -776,11 +890,14 @@ class CompiledCodeInfo:
         return timestamp >= self.timestamp and \
                (self.unload_time is None or self.unload_time > timestamp)
 
+    def _index(self):
+        """Build the maps from pc to the events and debug info at that pc."""
+        self.event_map = {event.pc: event for event in self.events}
+        self.debug_info_map = {debug_info.pc: debug_info for debug_info in self.debug_info or ()}
+
     def get_event_map(self):
         if self.event_map is None:
-            self.event_map = {}
-            for event in self.events:
-                self.event_map[event.pc] = event
+            self._index()
         return self.event_map
 
     def get_debug_info_map(self):
@@ -790,9 +907,7 @@ class CompiledCodeInfo:
         :rtype: dict[int, DebugInfo]
         """
         if self.debug_info_map is None:
-            self.debug_info_map = {}
-            for debug_info in self.debug_info:
-                self.debug_info_map[debug_info.pc] = debug_info
+            self._index()
         return self.debug_info_map
 
     def get_code_annotations(self, pc, show_call_stack_depth=None, hide_perf=False, short_class_names=False):
@@ -814,19 +929,20 @@ class CompiledCodeInfo:
 
         return annotations, prefix
 
-    def disassemble(self, decoder, short_class_names=False, threshold=0.001):
+    def disassemble(self, decoder, short_class_names=False, threshold=0.001, decoded=None):
         """
 
         :type decoder: DisassemblyDecoder
         """
         decoder.print(self.format_name(short_class_names=short_class_names))
         decoder.print(f'0x{self.code_begin():x}-0x{self.code_end():x} (samples={self.total_samples}, period={self.total_period})')
+        self._index()
         hotpc = {}
         for event in self.events:
-            event = copy.copy(event)
+            event = event.copy()
             event.percent = event.period * 100 / self.total_period
             hotpc[event.pc] = event
-        decoder.disassemble(self, hotpc, short_class_names=short_class_names, threshold=threshold)
+        decoder.disassemble(self, hotpc, short_class_names=short_class_names, threshold=threshold, decoded=decoded)
         decoder.print('')
 
     def check_basic_blocks_0_rel_freq(self, fp=sys.stdout):
@@ -882,6 +998,8 @@ def compare_freq(graal_freq, perf_freq, epsilon=1E-10):
 class PerfEvent:
     """A simple wrapper around a single recorded even from the perf command"""
 
+    __slots__ = ('dso', 'period', 'symbol', 'pc', 'events', 'timestamp', 'samples', 'percent')
+
     def __init__(self, timestamp, events, period, pc, symbol, dso):
         self.dso = dso
         self.period = int(period)
@@ -891,6 +1009,23 @@ class PerfEvent:
         self.timestamp = float(timestamp)
         self.samples = 1
 
+    @classmethod
+    def _make(cls, timestamp, events, period, pc, symbol, dso, samples=1):
+        """Build an event from already decoded fields, bypassing the string conversions of __init__."""
+        event = cls.__new__(cls)
+        event.dso = dso
+        event.period = period
+        event.symbol = symbol
+        event.pc = pc
+        event.events = events
+        event.timestamp = timestamp
+        event.samples = samples
+        return event
+
+    def copy(self):
+        """Returns a shallow copy of this event without going through the copy module."""
+        return PerfEvent._make(self.timestamp, self.events, self.period, self.pc, self.symbol, self.dso, self.samples)
+
     def __str__(self):
         return f'{self.timestamp} {self.pc:x} {self.events} {self.period} {self.symbol} {self.dso}'
 
@@ -1125,21 +1260,70 @@ class NativeImageBFDDemangler:
         return parameters
 
 
+class TeeReader(io.RawIOBase):
+    """A binary reader which writes everything read from source to sink."""
+
+    def __init__(self, source, sink):
+        super().__init__()
+        self.source = source
+        self.sink = sink
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.source.readinto(b)
+        if n:
+            self.sink.write(memoryview(b)[:n])
+        return n
+
+
 class PerfOutput:
     """The decoded output of a perf record execution"""
 
     _perf_available = None
 
-    def __init__(self, files):
+    def __init__(self, files, stream=None):
+        """
+        Parse the perf output of the experiment, or the lines from stream if one is provided.
+        """
         self.events = []
-        self.raw_events = []
         self.total_samples = 0
         self.total_period = 0
         self.top_methods = None
-        with files.open_perf_output_file() as fp:
-            self.read_perf_output(fp)
+        if stream is not None:
+            self.read_perf_output(stream)
+        else:
+            with files.open_perf_output_file() as fp:
+                self.read_perf_output(fp)
 
-        self.merge_perf_events()
+    @staticmethod
+    def convert_and_read(files, convert_cmd):
+        """
+        Run the conversion of the perf binary data into the perf output file of the experiment and parse the
+        output as it's produced instead of reading the file back afterwards.
+        """
+        # mx.run decodes the lines it passes to a callable out, so read the raw bytes to keep the perf output file
+        # identical to the one written by ensure_perf_output and decode them the way open_perf_output_file does
+        mx.logv(mx.list_to_cmd_line(convert_cmd))
+        copied = False
+        try:
+            with files.open_perf_output_file(mode='wb') as fp:
+                with subprocess.Popen(convert_cmd, stdout=subprocess.PIPE) as process:
+                    try:
+                        stream = io.TextIOWrapper(io.BufferedReader(TeeReader(process.stdout, fp), buffer_size=1 << 20))
+                        perf = PerfOutput(files, stream=stream)
+                    finally:
+                        # if parsing fails part way through still write out the complete perf output file
+                        shutil.copyfileobj(process.stdout, fp)
+                        copied = True
+        finally:
+            if (not copied or process.returncode != 0) and files.has_perf_output():
+                # remove the partial output so that ensure_perf_output converts it again
+                os.remove(files.get_perf_output_filename())
+        if process.returncode != 0:
+            mx.abort(f'{mx.list_to_cmd_line(convert_cmd)} failed with exit status {process.returncode}')
+        return perf
 
     @staticmethod
     def is_supported():
@@ -1168,70 +1352,111 @@ class PerfOutput:
         return convert_cmd
 
     def read_perf_output(self, fp):
-        """Parse the perf script output"""
-        perf_re = re.compile(
-            r'(?P<timestamp>[0-9]+\.[0-9]*):\s+(?P<period>[0-9]*)\s+(?P<events>[^\s]*):\s+'
-            r'(?P<pc>[a-fA-F0-9]+)\s+(?P<symbol>.*)\s+\((?P<dso>.*)\)\s*')
-        for line in fp.readlines():
-            line = line.strip()
-            m = perf_re.match(line)
-            if m:
-                event = PerfEvent(m.group('timestamp'), m.group('events'), m.group('period'),
-                                  m.group('pc'), m.group('symbol'), m.group('dso'))
-                self.events.append(event)
-                self.total_period += event.period
-            else:
-                raise AssertionError('Unable to parse perf output: ' + line)
-        self.total_samples = len(self.events)
+        """
+        Parse the perf script output, collecting repeated events at the same pc into a single PerfEvent.
 
-    def merge_perf_events(self):
-        """Collect repeated events at the same pc into a single PerfEvent."""
-        self.raw_events = self.events
+        The fixed fields at the start of a line are matched by perf_prefix_re and the symbol and dso are split
+        off by hand, which avoids the backtracking of the full perf_re.  Lines which don't fit that layout are
+        matched with perf_re.  Only the pc and period are converted for repeated samples at a pc.
+        """
         events_by_address = {}
+        total_period = 0
+        total_samples = 0
+        for line in fp:
+            m = None
+            fields = perf_prefix_re.match(line)
+            if fields:
+                rest = line[fields.end():].rstrip()
+                dso_start = rest.rfind(' (')
+                if dso_start < 0 or rest[-1:] != ')' or '(' in rest[dso_start + 2:]:
+                    # let perf_re decide where the symbol ends
+                    fields = None
+            if fields:
+                period, pc = fields.group(2, 4)
+            else:
+                line = line.strip()
+                m = perf_re.match(line)
+                if not m:
+                    raise AssertionError('Unable to parse perf output: ' + line)
+                period, pc = m.group('period', 'pc')
+            address = int(pc, 16)
+            period = int(period)
+            total_period += period
+            total_samples += 1
+            event = events_by_address.get(address)
+            if event:
+                event.period += period
+                event.samples += 1
+            else:
+                # the remaining fields are only extracted for the first sample at a pc
+                if m:
+                    timestamp, _, events, _, symbol, dso = m.groups()
+                else:
+                    timestamp, events = fields.group(1, 3)
+                    symbol = rest[:dso_start]
+                    dso = rest[dso_start + 2:-1]
+                events_by_address[address] = PerfEvent._make(float(timestamp), events, period, address, symbol, dso)
+
+        self.events.extend(events_by_address.values())
+        self.total_period += total_period
+        self.total_samples += total_samples
+
+    def aggregate_by_symbol(self):
+        """Sums the period and samples of the events for each (symbol, dso) pair."""
+        totals = {}
         for event in self.events:
-            e = events_by_address.get(event.pc)
-            if e:
-                e.period = e.period + event.period
-                e.samples = e.samples + event.samples
+            key = (event.symbol, event.dso)
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [event.period, event.samples]
             else:
-                # avoid mutating the underlying raw event
-                events_by_address[event.pc] = copy.copy(event)
-        self.events = events_by_address.values()
+                total[0] += event.period
+                total[1] += event.samples
+        return totals
 
     def get_top_methods(self):
         """Get a list of symbols and event counts sorted by hottest first."""
         if not self.top_methods:
-            hot_symbols = {}
-            for event in self.events:
-                key = (event.symbol, event.dso)
-                count = hot_symbols.get(key)
-                if count is None:
-                    count = 0
-                count = count + event.period
-                hot_symbols[key] = count
-            entries = [(s, d, c) for (s, d), c in hot_symbols.items()]
-
-            def count_func(v):
-                _, _, c = v
-                return c
-
-            entries.sort(key=count_func, reverse=True)
+            entries = [(s, d, period) for (s, d), (period, _) in self.aggregate_by_symbol().items()]
+            entries.sort(key=itemgetter(2), reverse=True)
             self.top_methods = entries
         return self.top_methods
 
     def get_perf_methods(self) -> Iterable[PerfMethod]:
         """Aggregates the samples by (symbol, dso) pairs."""
-        methods = {}
-        for event in self.events:
-            key = (event.symbol, event.dso)
-            period_count = methods.get(key)
-            if period_count is None:
-                methods[key] = [event.period, event.samples]
-            else:
-                period_count[0] += event.period
-                period_count[1] += event.samples
-        for key, period_count in methods.items():
-            yield PerfMethod(symbol=key[0], dso=key[1], total_period=period_count[0], samples=period_count[1])
+        for (symbol, dso), (period, samples) in self.aggregate_by_symbol().items():
+            yield PerfMethod(symbol=symbol, dso=dso, total_period=period, samples=samples)
+
+
+class CodeRangeIndex:
+    """
+    An index of code ranges sorted by start address so that the code containing a pc can be found with a
+    binary search.  The running maximum of the end addresses bounds how far back overlapping ranges need
+    to be considered.
+    """
+
+    def __init__(self, codes):
+        """
+
+        :type codes: list[CompiledCodeInfo]
+        """
+        self.positions = sorted(range(len(codes)), key=lambda i: codes[i].code_begin())
+        self.codes = [codes[i] for i in self.positions]
+        self.starts = array('Q', [code.code_begin() for code in self.codes])
+        self.ends = array('Q', [code.code_end() for code in self.codes])
+        self.max_ends = array('Q', accumulate(self.ends, max))
+
+    def search(self, pc):
+        """Returns all the code ranges containing pc in the order they were added."""
+        matches = []
+        i = bisect_right(self.starts, pc) - 1
+        while i >= 0 and pc < self.max_ends[i]:
+            if pc < self.ends[i]:
+                matches.append((self.positions[i], self.codes[i]))
+            i -= 1
+        if len(matches) > 1:
+            matches.sort(key=lambda match: match[0])
+        return [code for _, code in matches]
 
 
 class GeneratedAssembly:
@@ -1252,20 +1477,27 @@ class GeneratedAssembly:
         self.high_address = None
         self.code_by_address = {}
         self.code_by_id = {}
-        self.map = {}
-        self.bucket_size = 8192
+        self._index = None
+        self._stub_index = None
+        self._stub_names = {}
+        self._decoder = None
         with files.open_jvmti_asm_file() as fp:
-            self.fp = fp
-            tag = self.fp.read(8)
-            if tag != filetag:
-                raise AssertionError(f'Wrong magic number: Found {tag} but expected {filetag}')
-            self.major_version = self.read_jint()
-            self.minor_version = self.read_jint()
-            self.arch = self.read_string()
-            self.timestamp = self.read_timestamp()
-            self.java_nano_time = self.read_unsigned_jlong()
-            self.read(fp, verbose)
-            self.fp = None
+            self.buffer = GeneratedAssembly.map_file(fp)
+            self.position = 0
+            try:
+                tag = self.read_bytes(8)
+                if tag != filetag:
+                    raise AssertionError(f'Wrong magic number: Found {tag} but expected {filetag}')
+                self.major_version = self.read_jint()
+                self.minor_version = self.read_jint()
+                self.arch = self.read_string()
+                self.timestamp = self.read_timestamp()
+                self.java_nano_time = self.read_unsigned_jlong()
+                self.read(verbose)
+            finally:
+                if isinstance(self.buffer, mmap.mmap):
+                    self.buffer.close()
+                self.buffer = None
 
         if files.has_log_compilation():
             # try to attribute the nmethods to the JVMTI output so that compile ids are available
@@ -1316,30 +1548,46 @@ class GeneratedAssembly:
                         blocks.append(BasicBlock(int(block_id), int(start), int(end), float(freq)))
                     code.set_basic_blocks(blocks)
 
+    @staticmethod
+    def map_file(fp):
+        """Returns the contents of fp as a buffer, memory mapping it if it is backed by a file."""
+        try:
+            fileno = fp.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return fp.read()
+        if os.fstat(fileno).st_size == 0:
+            return b''
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
     def decoder(self, fp=sys.stdout):
+        """Returns the decoder for this architecture writing to fp.  The Capstone decoder is built once and reused."""
+        if self._decoder is None:
+            self._decoder = self.build_decoder(fp)
+        self._decoder.fp = fp
+        return self._decoder
+
+    def build_decoder(self, fp):
         if self.arch == 'amd64':
             return AMD64DisassemblerDecoder(fp)
         if self.arch == 'aarch64':
             return AArch64DisassemblyDecoder(fp)
         raise AssertionError('Unknown arch ' + self.arch)
 
-    def round_up(self, value):
-        return self.bucket_size * int((value + self.bucket_size - 1) / self.bucket_size)
-
-    def round_down(self, value):
-        return self.bucket_size * int(value / self.bucket_size)
-
     def build_search_map(self):
-        for code in self.code_info:
-            for pc in range(self.round_down(code.code_begin()), self.round_up(code.code_end()), self.bucket_size):
-                entries = self.map.get(pc)
-                if not entries:
-                    entries = []
-                    self.map[pc] = entries
-                entries.append(code)
+        self._index = CodeRangeIndex(self.code_info)
+        # stub names are looked up for every call instruction so keep a separate index of just the stubs
+        self._stub_index = CodeRangeIndex([code for code in self.code_info if code.generated])
+        self._stub_names = {}
+
+    def search(self, pc):
+        """Returns all the code ranges containing pc in the order they were added."""
+        if self._index is None:
+            self.build_search_map()
+        return self._index.search(pc)
 
     def add(self, code_info):
         self.code_info.append(code_info)
+        self._index = None
         if not self.low_address:
             self.low_address = code_info.code_begin()
             self.high_address = code_info.code_end()
@@ -1348,88 +1596,109 @@ class GeneratedAssembly:
             self.high_address = max(self.high_address, code_info.code_end())
         self.code_by_address[code_info.code_addr] = code_info
 
-    def read(self, fp, verbose=False):
+    def read(self, verbose=False):
+        handlers = {
+            DynamicCodeTag: self.read_dynamic_code,
+            CompiledMethodLoadTag: self.read_compiled_method_load,
+            CompiledMethodUnloadTag: self.read_compiled_method_unload,
+        }
         while True:
             tag = self.read_jint()
             if not tag:
                 return
-            if tag == DynamicCodeTag:
-                timestamp = self.read_timestamp()
-                name = self.read_string()
-                code_addr = self.read_unsigned_jlong()
-                code_size = self.read_jint()
-                code = fp.read(code_size)
-                code_info = CompiledCodeInfo(name, timestamp, code_addr, code_size, code, True)
-                self.add(code_info)
-                if verbose:
-                    print(f'Parsed DynamicCode {code_info}')
-            elif tag == CompiledMethodUnloadTag:
-                timestamp = self.read_timestamp()
-                code_addr = self.read_unsigned_jlong()
-                nmethod = self.code_by_address[code_addr]
-                if not nmethod:
-                    message = f"missing code for {code_addr}"
-                    mx.abort(message)
-                nmethod.set_unload_time(timestamp)
-                if verbose:
-                    print(f'Parsed CompiledMethodUnload {code_info}')
-            elif tag == CompiledMethodLoadTag:
-                timestamp = self.read_timestamp()
-                code_addr = self.read_unsigned_jlong()
-                code_size = self.read_jint()
-                code = fp.read(code_size)
-                tag = self.read_jint()
-                if tag != MethodsTag:
-                    mx.abort("Expected MethodsTag")
-                methods_count = self.read_jint()
-                methods = []
-                for _ in range(methods_count):
-                    class_signature = self.read_string()
-                    method_name = self.read_string()
-                    method_signature = self.read_string()
-                    source_file = self.read_string()
-
-                    line_number_table_count = self.read_jint()
-                    line_number_table = []
-                    for _ in range(line_number_table_count):
-                        line_number_table.append((self.read_unsigned_jlong(), self.read_jint()))
-                    method = Method(class_signature, method_name, method_signature, source_file, line_number_table)
-                    methods.append(method)
-
-                tag = self.read_jint()
-                if tag != DebugInfoTag:
-                    mx.abort("Expected DebugInfoTag")
-
-                numpcs = self.read_jint()
-                debug_infos = []
-                for _ in range(numpcs):
-                    pc = self.read_unsigned_jlong()
-                    numstackframes = self.read_jint()
-                    frames = []
-                    for _ in range(numstackframes):
-                        frames.append(DebugFrame(methods[self.read_jint()], self.read_jint()))
-                    debug_infos.append(DebugInfo(pc, frames))
-                nmethod = CompiledCodeInfo(methods[0].format_name(), timestamp, code_addr, code_size, code,
-                                           False, debug_infos, methods)
-                self.add(nmethod)
-                if verbose:
-                    print(f'Parsed CompiledMethod {nmethod}')
-            else:
+            handler = handlers.get(tag)
+            if handler is None:
                 raise AssertionError(f"Unexpected tag {tag}")
+            handler(verbose)
+
+    def read_dynamic_code(self, verbose):
+        timestamp = self.read_timestamp()
+        name = self.read_string()
+        code_addr = self.read_unsigned_jlong()
+        code_size = self.read_jint()
+        code = self.read_bytes(code_size)
+        code_info = CompiledCodeInfo(name, timestamp, code_addr, code_size, code, True)
+        self.add(code_info)
+        if verbose:
+            print(f'Parsed DynamicCode {code_info}')
+
+    def read_compiled_method_unload(self, verbose):
+        timestamp = self.read_timestamp()
+        code_addr = self.read_unsigned_jlong()
+        nmethod = self.code_by_address[code_addr]
+        if not nmethod:
+            message = f"missing code for {code_addr}"
+            mx.abort(message)
+        nmethod.set_unload_time(timestamp)
+        if verbose:
+            print(f'Parsed CompiledMethodUnload {nmethod}')
+
+    def read_compiled_method_load(self, verbose):
+        timestamp = self.read_timestamp()
+        code_addr = self.read_unsigned_jlong()
+        code_size = self.read_jint()
+        code = self.read_bytes(code_size)
+        tag = self.read_jint()
+        if tag != MethodsTag:
+            mx.abort("Expected MethodsTag")
+        methods_count = self.read_jint()
+        methods = [None] * methods_count
+        for index in range(methods_count):
+            class_signature = self.read_string()
+            method_name = self.read_string()
+            method_signature = self.read_string()
+            source_file = self.read_string()
+
+            # the line number table is an array of (unsigned jlong, jint) pairs so decode it in one go
+            line_number_table_count = self.read_jint()
+            line_number_table = list(LineNumberEntryStruct.iter_unpack(
+                self.read_bytes(line_number_table_count * LineNumberEntryStruct.size)))
+            methods[index] = Method(class_signature, method_name, method_signature, source_file, line_number_table)
+
+        tag = self.read_jint()
+        if tag != DebugInfoTag:
+            mx.abort("Expected DebugInfoTag")
+
+        numpcs = self.read_jint()
+        debug_infos = [None] * numpcs
+        read_struct = self.read_struct
+        read_jints = self.read_jints
+        for index in range(numpcs):
+            pc, numstackframes = read_struct(DebugInfoHeaderStruct)
+            # the frames are (method index, bci) jint pairs
+            frame_data = iter(read_jints(2 * numstackframes))
+            frames = [DebugFrame(methods[method_index], bci) for method_index, bci in zip(frame_data, frame_data)]
+            debug_infos[index] = DebugInfo(pc, frames)
+        nmethod = CompiledCodeInfo(methods[0].format_name(), timestamp, code_addr, code_size, code,
+                                   False, debug_infos, methods)
+        self.add(nmethod)
+        if verbose:
+            print(f'Parsed CompiledMethod {nmethod}')
 
     def attribute_events(self, perf_data):
         assert self.low_address is not None and self.high_address is not None
+        low_address = self.low_address
+        high_address = self.high_address
+        # select the events inside the code cache in one pass before resolving them individually
+        candidates = [event for event in perf_data.events if low_address <= event.pc < high_address]
+        if self._index is None:
+            self.build_search_map()
+        search = self._index.search
+        add_event = self.add_event
         attributed = 0
-        unknown = 0
-        missing = 0
-        for event in perf_data.events:
-            if self.low_address <= event.pc < self.high_address:
-                if self.add_event(event):
+        for event in candidates:
+            entries = search(event.pc)
+            if len(entries) != 1:
+                # overlapping code needs the timestamp to pick the right one
+                if entries and add_event(event):
                     attributed += 1
-                else:
-                    missing += 1
-            elif event.symbol == '[Unknown]':
-                unknown += 1
+                continue
+            code_info = entries[0]
+            code_info.add(event)
+            event.dso = '[Generated]' if code_info.generated else '[JIT]'
+            event.symbol = code_info.name
+            attributed += 1
+        missing = len(candidates) - attributed
         if missing > 50:
             # some versions of JVMTI leave out the stubs section of nmethod which occassionally gets ticks
             # so a small number of missing ticks should be ignored.
@@ -1448,35 +1717,26 @@ class GeneratedAssembly:
         else:
             return False
 
-    def search(self, pc):
-        matches = []
-        for code in self.code_info:
-            if code.contains(pc):
-                matches.append(code)
-        return matches
-
     def get_stub_name(self, pc):
         """Map a pc to the name of a stub plus an offset."""
-        for x in self.search(pc):
-            if x.generated:
-                offset = pc - x.code_addr
-                if offset:
-                    return f'{x.name}+0x{offset:x}'
-                return x.name
-        return None
+        if self._index is None:
+            self.build_search_map()
+        try:
+            return self._stub_names[pc]
+        except KeyError:
+            pass
+        name = None
+        stubs = self._stub_index.search(pc)
+        if stubs:
+            x = stubs[0]
+            offset = pc - x.code_addr
+            name = f'{x.name}+0x{offset:x}' if offset else x.name
+        self._stub_names[pc] = name
+        return name
 
     def find(self, pc, timestamp):
-        if not self.map:
-            self.build_search_map()
-        index = self.round_down(pc)
-        entries = self.map.get(index)
-        if entries:
-            entries = [x for x in entries if x.contains(pc)]
+        entries = self.search(pc)
         if not entries:
-            m = self.search(pc)
-            if m:
-                raise AssertionError(
-                    f'find has no hits for pc {pc:x} and timestamp {timestamp} but search found: {str([str(x) for x in m])}')
             return None
 
         # only a single PC match so don't bother checking the timestamp
@@ -1497,45 +1757,77 @@ class GeneratedAssembly:
 
     def print_all(self, codes=None, fp=sys.stdout, show_call_stack_depth=None, hide_perf=False,
                   threshold=None, short_class_names=False):
-        stub_name_cache = {}
-        for h in codes or self.code_info:
-            if h.name == 'Interpreter':
-                continue
-            decoder = self.decoder(fp=fp)
+        codes = [h for h in codes or self.code_info if h.name != 'Interpreter']
+        executor = None
+        decoded = repeat(None)
+        # the output is produced serially so a few workers are enough to stay ahead of it
+        workers = min(len(codes), os.cpu_count() or 1, 4)
+        if workers > 1 and sum(len(h.code) for h in codes) >= ParallelDecodeMinBytes:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            decoded = GeneratedAssembly.decode_ahead(executor, type(self.decoder(fp=fp)), codes, 2 * workers)
+        try:
+            for h, instructions in zip(codes, decoded):
+                self.print_code(h, instructions, fp, show_call_stack_depth, hide_perf, threshold, short_class_names)
+        finally:
+            if executor:
+                executor.shutdown()
 
-            def get_call_annotations(instruction):
-                return h.get_code_annotations(instruction.address, show_call_stack_depth=show_call_stack_depth,
-                                              hide_perf=hide_perf, short_class_names=short_class_names)
+    @staticmethod
+    def decode_ahead(executor, decoder_class, codes, window):
+        """
+        Yields the decode_lite_with_skip results for codes in order, decoding in the worker processes of
+        executor with at most window pieces of code in flight so that memory use stays bounded.
+        """
+        pending = deque()
+        for h in codes:
+            pending.append(executor.submit(decode_in_worker, decoder_class, h.code, h.code_addr))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def print_code(self, h, decoded, fp, show_call_stack_depth, hide_perf, threshold, short_class_names):
+        # render the whole method before writing it out in one piece
+        out = io.StringIO()
+        decoder = self.decoder(fp=out)
+
+        def get_call_annotations(instruction):
+            return h.get_code_annotations(instruction.address, show_call_stack_depth=show_call_stack_depth,
+                                          hide_perf=hide_perf, short_class_names=short_class_names)
+
+        def get_stub_call_name(instruction):
+            if 'call' in instruction.groups():
+                return self.get_stub_name(instruction.insn.operands[0].imm)
+            return None
 
-            def get_stub_call_name(instruction):
-                if 'call' in instruction.groups():
-                    call_pc = instruction.insn.operands[0].imm
-                    result = stub_name_cache.get(call_pc)
-                    if result:
-                        return None if result == stub_name_cache else result
-                    result = self.get_stub_name(call_pc)
-                    stub_name_cache[call_pc] = result or stub_name_cache
-                    return result
-                return None
+        decoder.set_annotators([get_stub_call_name, get_call_annotations])
 
-            decoder.add_annotator(get_stub_call_name)
-            decoder.add_annotator(get_call_annotations)
+        h.disassemble(decoder, short_class_names=short_class_names, threshold=threshold, decoded=decoded)
+        fp.write(out.getvalue())
 
-            h.disassemble(decoder, short_class_names=short_class_names, threshold=threshold)
+    def read_bytes(self, length):
+        position = self.position
+        self.position = position + length
+        assert self.position <= len(self.buffer), 'input truncated'
+        return self.buffer[position:self.position]
 
     def read_jint(self):
-        b = self.fp.read(4)
-        if not b:
+        position = self.position
+        if position == len(self.buffer):
             return None
-        assert b[3] is not None, 'input truncated'
-        return int.from_bytes(b, byteorder='big', signed=True)
+        assert position + 4 <= len(self.buffer), 'input truncated'
+        value, = JIntStruct.unpack_from(self.buffer, position)
+        self.position = position + 4
+        return value
 
     def read_unsigned_jlong(self):
-        b = self.fp.read(8)
-        if not b:
+        position = self.position
+        if position == len(self.buffer):
             return None
-        assert b[7] is not None, 'input truncated'
-        return int.from_bytes(b, byteorder='big', signed=False)
+        assert position + 8 <= len(self.buffer), 'input truncated'
+        value, = JLongStruct.unpack_from(self.buffer, position)
+        self.position = position + 8
+        return value
 
     def read_string(self):
         length = self.read_jint()
@@ -1543,20 +1835,35 @@ class GeneratedAssembly:
             return None
         if length == 0:
             return ''
-        body = self.fp.read(length)
-        return body.decode('utf-8')
+        return self.read_bytes(length).decode('utf-8')
+
+    def read_struct(self, layout):
+        position = self.position
+        self.position = position + layout.size
+        assert self.position <= len(self.buffer), 'input truncated'
+        return layout.unpack_from(self.buffer, position)
+
+    def read_jints(self, count):
+        position = self.position
+        self.position = position + 4 * count
+        assert self.position <= len(self.buffer), 'input truncated'
+        return struct.unpack_from(f'>{count}i', self.buffer, position)
 
     def read_timestamp(self):
-        sec = self.read_unsigned_jlong()
-        nsec = self.read_unsigned_jlong()
+        sec, nsec = self.read_struct(TimestampStruct)
         return sec + (nsec / 1000000000.0)
 
-    def top_methods(self, include=None):
+    def top_methods(self, include=None, limit=None):
+        """
+        Returns the code sorted by total period, hottest first, without reordering code_info.  If limit is
+        provided only the hottest limit entries are selected, which avoids sorting all of the code.
+        """
         entries = self.code_info
         if include:
             entries = [x for x in entries if include(x)]
-        entries.sort(key=lambda x: x.total_period, reverse=True)
-        return entries
+        if limit is not None:
+            return heapq.nlargest(limit, entries, key=attrgetter('total_period'))
+        return sorted(entries, key=attrgetter('total_period'), reverse=True)
 
 
 def find_jvmti_asm_agent():
@@ -1616,7 +1923,7 @@ def profrecord(args):
     parser.add_argument('-l', '--dump-level', help='The Graal dump level to use with the --dump-hot option',
                         action='store', default=1)
     parser.add_argument('-L', '--limit', help='The number of hot methods to dump with the --dump-hot option',
-                        action='store', default=5)
+                        action='store', default=5, type=int)
     parser.add_argument('-F', '--frequency', help='Frequency argument passed to perf',
                         action='store', default=1000)
     parser.add_argument('-e', '--event', help='Event argument passed to perf.\n'
@@ -1658,17 +1965,20 @@ def profrecord(args):
         if not files.has_perf_binary():
             mx.abort('No perf binary file found')
 
-        # convert the perf binary data into text format
-        with files.open_perf_output_file(mode='w') as fp:
-            mx.run(convert_cmd, out=fp)
+        # convert the perf binary data into text format, parsing it as it's written if it's needed for dumping
+        perf = None
+        if options.dump_hot and not is_native_image:
+            perf = PerfOutput.convert_and_read(files, convert_cmd)
+        else:
+            with files.open_perf_output_file(mode='w') as fp:
+                mx.run(convert_cmd, out=fp)
 
         if options.dump_hot:
             if is_native_image:
                 mx.abort('The option "dump hot" is not available for native executables.')
             assembly = GeneratedAssembly(files)
-            perf = PerfOutput(files)
             assembly.attribute_events(perf)
-            top = assembly.top_methods(include=lambda x: not x.generated and x.total_period > 0)[:options.limit]
+            top = assembly.top_methods(include=lambda x: not x.generated and x.total_period > 0, limit=options.limit)
             dump_path = files.create_dump_dir()
             method_filter = ','.join([x.methods[0].method_filter_format() for x in top])
             dump_arguments = [f'-Dgraal.Dump=:{options.dump_level}',
@@ -1681,7 +1991,10 @@ def profrecord(args):
             # This overwrites the original profile information with a new profile that might be different
             # because of the effects of dumping.  This command might need to be smarter about the side effects
             # of dumping on the performance since the overhead of dumping might perturb the execution.  It's not
-            # entirely clear how to cope with that though.
+            # entirely clear how to cope with that though.  The Graal dump options are only read when the compiler
+            # is initialized, and aren't VM flags that jcmd could set, so they can't be enabled part way through
+            # the first run.  The perf output must also be converted again because the rerun replaces the perf
+            # binary, the JVMTI dump and the LogCompilation output the first profile was attributed against.
             full_cmd = build_capture_command(files, options.command, extra_vm_args=dump_arguments, options=options)
             convert_cmd = PerfOutput.perf_convert_binary_command(files)
             mx.run(full_cmd)
@@ -1845,8 +2158,7 @@ def profhot(args):
                 print(f'            {dso}', file=fp)
         print('', file=fp)
 
-        hot = assembly.top_methods(lambda x: x.total_period > 0)
-        hot = hot[:options.limit]
+        hot = assembly.top_methods(lambda x: x.total_period > 0, limit=options.limit)
         print('Hot generated code:', file=fp)
         print('  Percent   Name', file=fp)
         for code in hot:
@@ -1888,8 +2200,7 @@ def checkblocks(args):
     if options.output:
         fp = open(options.output, 'w')
 
-    hot = assembly.top_methods(lambda x: x.total_period > 0 and x.basic_blocks)
-    hot = hot[:options.limit]
+    hot = assembly.top_methods(lambda x: x.total_period > 0 and x.basic_blocks, limit=options.limit)
 
     for code in hot:
         print(f"for hot method {code.name} with {len(code.basic_blocks)} basic blocks, got {code.total_samples} samples", file=fp)
@@ -1949,7 +2260,6 @@ def profjson(args):
         fp = open(options.output, 'w')
     if files.has_native_image_tag():
         CppDemangler.warn_if_unsupported()
-        perf_data.merge_perf_events()
         out = {
             'compilationKind': 'AOT',
             'totalPeriod': perf_data.total_period,